@@ -1,6 +1,16 @@
+import errno
+import glob
+import io
+import logging
+import logging.handlers
+import mmap
 import os
+import queue
+import signal
+import sys
+import threading
 import time
-from datetime import datetime
+from datetime import datetime, timezone
 
 # libcamera is used to reference AwbModeEnum for manual white balance
 import libcamera
@@ -13,11 +23,205 @@ def create_output_directory(base_path: str) -> str:
     Example: If base_path = "/home/pi/Pictures", 
     this might create "/home/pi/Pictures/20250103_101500" (YYYYMMDD_HHMMSS).
     """
-    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+    timestamp = datetime.now(FILENAME_TZ).strftime("%Y%m%d_%H%M%S")
     directory = os.path.join(base_path, timestamp)
     os.makedirs(directory, exist_ok=True)
     return directory
 
+def pin_to_cpus(cpus) -> None:
+    """
+    Restricts the calling thread to the given CPU cores (on Linux, pid 0 means
+    the calling thread only). Threads started afterwards inherit the same set.
+    Does nothing if cpus is None.
+    """
+    if cpus is None:
+        return
+    try:
+        os.sched_setaffinity(0, cpus)
+    except OSError as exc:
+        print(f"[WARN] Could not pin thread to CPUs {sorted(cpus)}: {exc}")
+
+def set_cpu_governor(governor: str) -> dict:
+    """
+    Sets the cpufreq scaling governor on every CPU frequency policy and returns
+    the previous governor of each policy it changed, so it can be restored on
+    exit.
+
+    Cores that share a clock (all four on the Pi 4 and Pi 5) share one policy,
+    so policies are used rather than per-core paths, and every governor is
+    read before any is written. Writing the governor needs root. If it cannot
+    be changed, a warning is printed and the remaining policies are left as
+    they are.
+    """
+    paths = sorted(glob.glob("/sys/devices/system/cpu/cpufreq/policy*/scaling_governor"))
+    try:
+        original = {}
+        for path in paths:
+            with open(path) as f:
+                original[path] = f.read().strip()
+    except OSError as exc:
+        print(f"[WARN] Could not read CPU governor: {exc}")
+        return {}
+
+    previous = {}
+    for path in paths:
+        try:
+            with open(path, "w") as f:
+                f.write(governor)
+        except OSError as exc:
+            print(f"[WARN] Could not set CPU governor to '{governor}': {exc}")
+            break
+        previous[path] = original[path]
+    return previous
+
+def restore_cpu_governors(previous: dict) -> None:
+    """
+    Restores the governors returned by set_cpu_governor().
+    """
+    for path, governor in previous.items():
+        try:
+            with open(path, "w") as f:
+                f.write(governor)
+        except OSError as exc:
+            print(f"[WARN] Could not restore CPU governor via {path}: {exc}")
+
+# Signals that stop the script: Ctrl+C, "kill"/"systemctl stop", and the SSH
+# session it was started from dropping
+STOP_SIGNALS = (signal.SIGINT, signal.SIGTERM, signal.SIGHUP)
+
+# Per-shot messages from the capture loop go through this logger
+capture_log = logging.getLogger(__name__)
+
+# O_DIRECT requires the buffer address and transfer size to be block-aligned.
+DIRECT_IO_ALIGNMENT = 4096
+
+def write_image(file_path: str, data: bytes) -> None:
+    """
+    Writes an encoded image to disk with direct I/O, so that long shoots do not
+    fill the page cache with JPEGs that are never read back.
+
+    The data is copied into a page-aligned buffer padded to a whole block,
+    written in one call, and the file is then truncated to its real size.
+    Filesystems that reject O_DIRECT, either when opening or when writing, or
+    that write only part of the buffer, fall back to a normal buffered write.
+    The write is not synced here; image_writer() syncs in batches instead of
+    forcing a journal commit for every file.
+    """
+    flags = os.O_WRONLY | os.O_CREAT | os.O_TRUNC | os.O_DIRECT
+    try:
+        fd = os.open(file_path, flags, 0o644)
+    except OSError as exc:
+        if exc.errno != errno.EINVAL:
+            raise
+        write_image_buffered(file_path, data)
+        return
+
+    size = len(data)
+    aligned_size = max(DIRECT_IO_ALIGNMENT, -(-size // DIRECT_IO_ALIGNMENT) * DIRECT_IO_ALIGNMENT)
+    try:
+        # Anonymous mmaps are page-aligned and zero-filled, so the tail is
+        # already padded
+        with mmap.mmap(-1, aligned_size) as buf:
+            buf[:size] = data
+            written = os.write(fd, buf)
+        if written == aligned_size:
+            os.ftruncate(fd, size)
+    except OSError as exc:
+        # Some filesystems (FUSE, network mounts) accept O_DIRECT at open
+        # but reject the write itself
+        if exc.errno != errno.EINVAL:
+            raise
+        written = None
+    finally:
+        os.close(fd)
+
+    if written != aligned_size:
+        write_image_buffered(file_path, data)
+
+def write_image_buffered(file_path: str, data: bytes) -> None:
+    """
+    Writes an encoded image through the page cache, for filesystems where
+    write_image() cannot use direct I/O. The data is fdatasync'ed, since the
+    batched sync in image_writer() only covers the newest file's cached data.
+    """
+    with open(file_path, "wb") as f:
+        f.write(data)
+        f.flush()
+        os.fdatasync(f.fileno())
+
+def sync_images(directory: str, newest_path: str) -> None:
+    """
+    Makes the images written so far durable by fsyncing the newest image and
+    then the directory holding them.
+
+    On ext4, fsyncing the newest image forces the journal transaction with
+    its extent and size updates, and with it every earlier transaction, so
+    older images in the batch are covered too. The directory fsync makes
+    sure the newest entries themselves are on disk.
+    """
+    fd = os.open(newest_path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+    fd = os.open(directory, os.O_RDONLY | os.O_DIRECTORY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+def image_writer(save_queue: queue.Queue, output_directory: str) -> None:
+    """
+    Background worker that saves captured requests to disk.
+
+    Takes (request, file_path) pairs off the queue and encodes the "main"
+    stream to JPEG in memory. The request is released back to libcamera as
+    soon as encoding is done, so the camera buffer is never held while the
+    file is written. Written images are synced (see sync_images()) once
+    every SYNC_EVERY_N_FRAMES images and again on exit. A None item stops
+    the worker.
+    """
+    pin_to_cpus(WRITER_CPUS)
+    unsynced = 0
+    newest_path = None
+    while True:
+        item = save_queue.get()
+        if item is None:
+            break
+
+        request, file_path = item
+        try:
+            # The Pi 5 has no hardware JPEG encoder (picamera2's MJPEGEncoder
+            # is software there too), so encoding stays on this thread, off
+            # the capture path.
+            jpeg = io.BytesIO()
+            try:
+                request.save("main", jpeg, format="jpeg")
+            finally:
+                request.release()
+
+            write_image(file_path, jpeg.getvalue())
+            newest_path = file_path
+            unsynced += 1
+        except Exception as exc:
+            print(f"[ERROR] Failed to save {file_path}: {exc}")
+
+        if unsynced >= SYNC_EVERY_N_FRAMES:
+            # Reset even on failure, so a failing sync is retried once per
+            # batch rather than on every frame
+            unsynced = 0
+            try:
+                sync_images(output_directory, newest_path)
+            except OSError as exc:
+                print(f"[ERROR] Failed to sync {output_directory}: {exc}")
+
+    if unsynced:
+        try:
+            sync_images(output_directory, newest_path)
+        except OSError as exc:
+            print(f"[ERROR] Failed to sync {output_directory}: {exc}")
+
 # -----------------------------------------------------------------------------
 #                           Configuration Section
 # -----------------------------------------------------------------------------
@@ -31,6 +235,34 @@ INTERVAL_SECONDS = 10
 # Toggle between fully automatic (True) and manual (False) camera mode.
 FULLY_AUTO_MODE = True  # Set to False to test manual exposure and gain control
 
+# Timestamp folder and image names in UTC instead of local time. UTC skips the
+# local timezone conversion on every shot and avoids duplicate or missing
+# names around daylight saving changes.
+USE_UTC_FILENAMES = False
+FILENAME_TZ = timezone.utc if USE_UTC_FILENAMES else None
+
+# Number of images written between syncs of the output. Syncing in batches
+# avoids a filesystem journal commit for every image. Each sync fsyncs the
+# newest image and the output directory; on ext4 with direct I/O that covers
+# the whole batch, so at most this many of the newest images can be lost on a
+# power cut. Filesystems without direct I/O support are synced after every
+# image instead.
+SYNC_EVERY_N_FRAMES = 32
+
+# CPU cores for the capture loop (and the libcamera threads it starts) and for
+# the JPEG writer thread. Keeping them apart stops encoding and disk writes from
+# delaying captures. The Pi 5 has four cores; set either to None to not pin.
+CAPTURE_CPUS = {0, 1}
+WRITER_CPUS = {2, 3}
+
+# CPU frequency governor used while capturing. "performance" stops the CPU from
+# clocking down between shots and ramping up again on every capture. Set to
+# None to leave the system setting alone. Changing it requires root.
+CPU_GOVERNOR = "performance"
+
+# Niceness adjustment for the capture process (negative values require root).
+CAPTURE_NICE = -5
+
 # -----------------------------------------------------------------------------
 
 #                             Auto Mode Settings
@@ -79,20 +311,101 @@ AWB_MODE_MAP = {
     "cloudy":       libcamera.controls.AwbModeEnum.Cloudy
 }
 
+# AWB_MODE_MAP resolved once into (AwbEnable, AwbMode) pairs, so applying a
+# white balance setting is a single lookup
+AWB_RESOLVED = {mode: (False, awb_mode) for mode, awb_mode in AWB_MODE_MAP.items()}
+AWB_RESOLVED["auto"] = (True, None)
+
+def build_manual_controls(settings: dict) -> dict:
+    """
+    Translates MANUAL_SETTINGS-style settings into a libcamera controls dict.
+    """
+    controls = {
+        "Brightness": settings["brightness"],
+        "Contrast":   settings["contrast"],
+        "Saturation": settings["saturation"],
+        "Sharpness":  settings["sharpness"]
+    }
+
+    # -------------------------------
+    # Handle Exposure
+    # -------------------------------
+    if settings["exposure_time"] is not None:
+        # Manual exposure: disable auto exposure and set ExposureTime
+        controls["AeEnable"] = False
+        controls["ExposureTime"] = settings["exposure_time"]
+
+        # Optionally lock analog gain at 1.0 to reduce overexposure further:
+        # (only if your PiCamera2 + libcamera version supports it)
+        controls["AnalogueGain"] = 1.0
+    else:
+        # Auto exposure
+        controls["AeEnable"] = True
+
+    # -------------------------------
+    # Handle White Balance
+    # -------------------------------
+    # If invalid string, default to auto
+    awb_enable, awb_mode = AWB_RESOLVED.get(settings["white_balance"].lower(), (True, None))
+    controls["AwbEnable"] = awb_enable
+    if not awb_enable:
+        controls["AwbMode"] = awb_mode
+
+    return controls
+
+# Manual mode controls, built once at import time. Treat as read-only.
+MANUAL_CONTROLS = build_manual_controls(MANUAL_SETTINGS)
+
 def main():
     """
-    Main function: initializes the PiCamera2, configures it for either
-    auto or manual mode, then captures images at fixed intervals.
+    Main function: switches the CPU governor, runs the capture session, and
+    restores the governor however the session ends, including failures
+    during camera setup.
+    """
+    # Make every stop signal raise KeyboardInterrupt rather than kill the
+    # process outright, so the finally below always gets to restore the
+    # system-wide governor
+    for signum in STOP_SIGNALS:
+        signal.signal(signum, signal.default_int_handler)
+
+    previous_governors = {}
+    if CPU_GOVERNOR is not None:
+        previous_governors = set_cpu_governor(CPU_GOVERNOR)
+        if previous_governors:
+            print(f"[INFO] CPU governor set to '{CPU_GOVERNOR}'.")
+
+    try:
+        capture_images()
+    finally:
+        restore_cpu_governors(previous_governors)
+
+def capture_images():
+    """
+    Initializes the PiCamera2, configures it for either auto or manual mode,
+    then captures images at fixed intervals until stopped.
     """
+    try:
+        os.nice(CAPTURE_NICE)
+    except OSError as exc:
+        print(f"[WARN] Could not adjust process priority: {exc}")
+
+    # Pin before creating the camera so libcamera's threads inherit the set
+    pin_to_cpus(CAPTURE_CPUS)
     picam = Picamera2()
 
     # -------------------------------------------------------------------------
     #               Configure Camera for Auto or Manual Mode
     # -------------------------------------------------------------------------
+    # A single buffer keeps CMA usage down, and queue=False makes each capture
+    # wait for a fresh frame rather than returning one queued up earlier.
+    # The main stream keeps the default RGB format: the ISP produces it
+    # directly, and picamera2 cannot JPEG-encode YUV420 buffers.
     if FULLY_AUTO_MODE:
         # AUTO mode: set only resolution, let camera handle everything else
         auto_config = picam.create_still_configuration(
-            main={"size": AUTO_SETTINGS["resolution"]}
+            main={"size": AUTO_SETTINGS["resolution"]},
+            buffer_count=1,
+            queue=False
         )
         picam.configure(auto_config)
         print("[INFO] Camera configured for FULLY AUTO mode.")
@@ -101,58 +414,31 @@ def main():
     else:
         # MANUAL mode: specify resolution and custom controls
         manual_config = picam.create_still_configuration(
-            main={"size": MANUAL_SETTINGS["resolution"]}
+            main={"size": MANUAL_SETTINGS["resolution"]},
+            buffer_count=1,
+            queue=False
         )
         picam.configure(manual_config)
 
-        # Build the controls dictionary
-        controls = {
-            "Brightness": MANUAL_SETTINGS["brightness"],
-            "Contrast":   MANUAL_SETTINGS["contrast"],
-            "Saturation": MANUAL_SETTINGS["saturation"],
-            "Sharpness":  MANUAL_SETTINGS["sharpness"]
-        }
-
         # -------------------------------
-        # Handle Exposure
+        # Report Exposure and White Balance
         # -------------------------------
         if MANUAL_SETTINGS["exposure_time"] is not None:
-            # Manual exposure: disable auto exposure and set ExposureTime
-            controls["AeEnable"] = False
-            controls["ExposureTime"] = MANUAL_SETTINGS["exposure_time"]
-
-            # Optionally lock analog gain at 1.0 to reduce overexposure further:
-            # (only if your PiCamera2 + libcamera version supports it)
-            controls["AnalogueGain"] = 1.0
-
             print(f"[INFO] Using manual exposure: {MANUAL_SETTINGS['exposure_time']} µs")
             print("[INFO] Locked AnalogueGain at 1.0 for minimal sensor amplification.")
         else:
-            # Auto exposure
-            controls["AeEnable"] = True
             print("[INFO] Auto exposure enabled.")
 
-        # -------------------------------
-        # Handle White Balance
-        # -------------------------------
         wb_mode_str = MANUAL_SETTINGS["white_balance"].lower()
-        if wb_mode_str in AWB_MODE_MAP:
-            if wb_mode_str == "auto":
-                # Auto white balance
-                controls["AwbEnable"] = True
-                print("[INFO] Auto white balance enabled.")
-            else:
-                # Manual white balance
-                controls["AwbEnable"] = False
-                controls["AwbMode"] = AWB_MODE_MAP[wb_mode_str]
-                print(f"[INFO] White balance mode set to '{wb_mode_str}'.")
-        else:
-            # If invalid string, default to auto
-            controls["AwbEnable"] = True
+        if wb_mode_str not in AWB_RESOLVED:
             print(f"[WARN] Unrecognized white_balance '{wb_mode_str}', defaulting to auto WB.")
+        elif MANUAL_CONTROLS["AwbEnable"]:
+            print("[INFO] Auto white balance enabled.")
+        else:
+            print(f"[INFO] White balance mode set to '{wb_mode_str}'.")
 
-        # Apply the manual controls
-        picam.set_controls(controls)
+        # Apply the manual controls (resolved once at import time)
+        picam.set_controls(MANUAL_CONTROLS)
 
         # Log settings
         print("[INFO] Camera configured for MANUAL mode with these settings:")
@@ -175,29 +461,99 @@ def main():
     output_directory = create_output_directory(OUTPUT_BASE_PATH)
     print(f"[INFO] Images will be saved in: {output_directory}")
 
+    # Captured requests are handed to a writer thread. The queue is bounded so
+    # that a slow disk applies backpressure instead of piling up buffers.
+    save_queue = queue.Queue(maxsize=2)
+    writer = threading.Thread(target=image_writer, args=(save_queue, output_directory),
+                              daemon=True)
+    writer.start()
+
+    # Per-shot log records are queued and printed by a listener thread, so the
+    # capture loop never blocks on a terminal write
+    log_queue = queue.SimpleQueue()
+    capture_log.addHandler(logging.handlers.QueueHandler(log_queue))
+    capture_log.setLevel(logging.INFO)
+    capture_log.propagate = False
+    log_listener = logging.handlers.QueueListener(log_queue, logging.StreamHandler(sys.stdout))
+    log_listener.start()
+
     # -------------------------------------------------------------------------
-    #            Image Capture Loop (Runs Until KeyboardInterrupt)
+    #     Image Capture Loop (Runs Until Ctrl+C, SIGTERM or SIGHUP)
     # -------------------------------------------------------------------------
+    # The first stop signal only sets a flag, so an in-flight capture always
+    # completes and is handed to the writer before the loop exits. A second
+    # one raises KeyboardInterrupt, which can still break out of a capture or
+    # enqueue that is stuck.
+    stop_requested = False
+
+    def request_stop(signum, frame):
+        nonlocal stop_requested
+        stop_requested = True
+        for stop_signum in STOP_SIGNALS:
+            signal.signal(stop_signum, signal.default_int_handler)
+
+    for signum in STOP_SIGNALS:
+        signal.signal(signum, request_stop)
+
+    # Longest time a stop signal can go unnoticed while waiting between shots
+    stop_poll_seconds = 0.2
+
     try:
         print("[INFO] Starting image capture. Press Ctrl+C to stop.\n")
-        while True:
+        # The directory part of every filename is fixed, so join it only once
+        file_prefix = os.path.join(output_directory, "image_")
+
+        # Schedule captures against a monotonic deadline so the time spent
+        # capturing does not add up as drift over a long time-lapse
+        next_capture = time.monotonic()
+
+        # Bind the names used on every shot to locals, so each iteration
+        # avoids repeated global and attribute lookups
+        now = datetime.now
+        tz = FILENAME_TZ
+        monotonic = time.monotonic
+        sleep = time.sleep
+        log_capture = capture_log.info
+        capture_request = picam.capture_request
+        enqueue = save_queue.put
+        interval = INTERVAL_SECONDS
+
+        while not stop_requested:
             # Create a timestamped filename, e.g. "image_20250103_101500.jpg"
-            timestamp_str = datetime.now().strftime("image_%Y%m%d_%H%M%S.jpg")
-            file_path = os.path.join(output_directory, timestamp_str)
+            # (built from the datetime fields directly, avoiding strftime's
+            # format parsing on every shot)
+            n = now(tz)
+            file_path = (f"{file_prefix}{n.year:04d}{n.month:02d}{n.day:02d}_"
+                         f"{n.hour:02d}{n.minute:02d}{n.second:02d}.jpg")
 
-            # Capture the image
-            print(f"[CAPTURE] Saving image: {file_path}")
-            picam.capture_file(file_path)
+            # Capture the image; encoding and saving happen on the writer thread
+            log_capture("[CAPTURE] Saving image: %s", file_path)
+            request = capture_request()
+            enqueue((request, file_path))
 
-            # Wait for the specified interval
-            time.sleep(INTERVAL_SECONDS)
+            # Wait until the next capture is due, in short steps so a stop
+            # signal is noticed promptly. After a stall (slow disk, full queue)
+            # skip the missed slots rather than firing catch-up shots that
+            # would reuse the same filename.
+            next_capture += interval
+            current = monotonic()
+            if next_capture < current:
+                next_capture = current
+            while not stop_requested and current < next_capture:
+                sleep(min(next_capture - current, stop_poll_seconds))
+                current = monotonic()
 
-    except KeyboardInterrupt:
-        # Gracefully handle Ctrl+C
         print("\n[INFO] Stopping image capture...")
 
+    except KeyboardInterrupt:
+        # Second stop signal: stop without waiting for the current shot
+        print("\n[INFO] Capture interrupted.")
+
     finally:
-        # Stop the camera no matter how the loop ended
+        # Let the writer finish any queued images, then stop the camera
+        save_queue.put(None)
+        writer.join()
+        log_listener.stop()
         picam.stop()
         print("[INFO] Camera stopped. Exiting.")
 